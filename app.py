@@ -1,12 +1,58 @@
 import streamlit as st
 import pandas as pd
-import tempfile
 import os
 import io
+import re
+import string
+import tempfile
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
 
 from barcode import EAN13, EAN8, Code128
-from barcode.writer import ImageWriter
+from barcode.writer import SVGWriter
+import numpy as np
+import openpyxl
 import xlsxwriter
+from PIL import Image
+
+
+# Geometrie der Barcode-Bilder. Ohne Klartext unter den Balken reichen
+# eine geringere Balkenhöhe und eine schmale Ruhezone (die EAN steht ja
+# schon in der Tabelle) – kleinere Bilder sind schneller gezeichnet und
+# kodiert. Die Modulbreite bleibt bei 300 dpi, damit die Balken nach dem
+# Skalieren in Excel scannbar bleiben.
+_DPI = 300
+_MODULE_WIDTH_MM = 0.2
+_MODULE_HEIGHT_MM = 10.0
+_QUIET_ZONE_MM = 2.0
+
+# Standard-Zeilenhöhe in Excel (Punkte)
+_EXCEL_ROW_HEIGHT = 15
+
+# Barcode-Typ nach Länge der EAN; Code128 als Fallback für
+# „ungewöhnliche“ Längen
+_BC_BY_LEN = {13: EAN13, 8: EAN8}
+
+# Rendern im Prozess-Pool erst ab so vielen verschiedenen Barcodes (ein
+# Bild kostet nur ca. 0,3 ms, das Starten der Worker einige 10 ms) und
+# mit höchstens so vielen Workern
+_POOL_MIN_TASKS = 1000
+_POOL_MAX_WORKERS = 4
+
+# Alles außer Ziffern (für die EAN-Bereinigung)
+_NONDIGIT = re.compile(r"\D+")
+
+# Alle Spaltenbuchstaben A … ZZZ → 0-basierter Index, einmal beim Import
+# berechnet (A=0, …, Z=25, AA=26, …)
+_COL_IDX = {
+    "".join(letters): i
+    for i, letters in enumerate(
+        letters
+        for n in (1, 2, 3)
+        for letters in product(string.ascii_uppercase, repeat=n)
+    )
+}
 
 
 def excel_col_to_index(col: str) -> int:
@@ -15,12 +61,138 @@ def excel_col_to_index(col: str) -> int:
     einen 0-basierten Index um (A=0, B=1, ...).
     """
     col = col.strip().upper()
-    result = 0
-    for ch in col:
-        if not ("A" <= ch <= "Z"):
-            raise ValueError(f"Ungültiger Spaltenbuchstabe: {col}")
-        result = result * 26 + (ord(ch) - ord("A") + 1)
-    return result - 1  # 0-basiert
+    try:
+        return _COL_IDX[col]
+    except KeyError:
+        raise ValueError(f"Ungültiger Spaltenbuchstabe: {col}") from None
+
+
+def _worker_count() -> int:
+    """
+    Anzahl Worker für den Prozess-Pool: die für diesen Prozess nutzbaren
+    CPUs (nicht alle des Hosts), höchstens _POOL_MAX_WORKERS.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # nicht unter Linux
+        cpus = os.cpu_count() or 1
+    return min(cpus, _POOL_MAX_WORKERS)
+
+
+def _mm2px(mm: float) -> int:
+    return max(1, round(mm * _DPI / 25.4))
+
+
+# Pixelmaße einmal beim Import berechnen statt pro Barcode
+_BAR_HEIGHT_PX = _mm2px(_MODULE_HEIGHT_MM)
+_QUIET_PX = _mm2px(_QUIET_ZONE_MM)
+_MODULE_PX = _mm2px(_MODULE_WIDTH_MM)
+
+# Ein gemeinsamer Writer für alle Barcode-Objekte – ohne writer= legt
+# python-barcode für jedes Objekt einen neuen an. Gebraucht wird davon
+# nur build(), gezeichnet wird in _bars_to_png().
+_WRITER = SVGWriter()
+
+
+def _pattern_table(patterns) -> np.ndarray:
+    return np.array([[ch == "1" for ch in p] for p in patterns], dtype=bool)
+
+
+# EAN-13-Codetabellen (Ziffer → 7 Module, True = Balken). G ist R
+# gespiegelt, R ist L invertiert.
+_EAN_L = _pattern_table(
+    [
+        "0001101", "0011001", "0010011", "0111101", "0100011",
+        "0110001", "0101111", "0111011", "0110111", "0001011",
+    ]
+)
+_EAN_R = ~_EAN_L
+_EAN_G = _EAN_R[:, ::-1]
+
+# Erste Ziffer → welche der 6 linken Ziffern mit G statt L kodiert werden
+_EAN_PARITY = np.array(
+    [
+        [ch == "G" for ch in p]
+        for p in (
+            "LLLLLL", "LLGLGG", "LLGGLG", "LLGGGL", "LGLLGG",
+            "LGGLLG", "LGGGLL", "LGLGLG", "LGLGGL", "LGGLGL",
+        )
+    ]
+)
+_EAN_EDGE = np.array([True, False, True])
+_EAN_MIDDLE = np.array([False, True, False, True, False])
+
+
+def _encode_ean13_batch(codes: list[str]) -> np.ndarray:
+    """
+    Kodiert beliebig viele EAN-13 auf einmal in ihre 95 Module
+    (True = Balken), Ergebnis hat die Form (Anzahl, 95). Die Prüfziffer
+    wird wie bei python-barcode aus den ersten 12 Ziffern neu berechnet.
+    """
+    digits = np.frombuffer("".join(codes).encode("ascii"), dtype=np.uint8)
+    digits = digits.reshape(-1, 13)[:, :12].astype(np.intp) - ord("0")
+    n = len(digits)
+
+    odd = digits[:, ::2].sum(axis=1)
+    even = digits[:, 1::2].sum(axis=1)
+    check = (10 - (odd + 3 * even) % 10) % 10
+
+    left = np.where(
+        _EAN_PARITY[digits[:, 0]][:, :, None],
+        _EAN_G[digits[:, 1:7]],
+        _EAN_L[digits[:, 1:7]],
+    )
+    right = _EAN_R[np.column_stack((digits[:, 7:], check))]
+    return np.hstack(
+        (
+            np.broadcast_to(_EAN_EDGE, (n, _EAN_EDGE.size)),
+            left.reshape(n, 6 * 7),
+            np.broadcast_to(_EAN_MIDDLE, (n, _EAN_MIDDLE.size)),
+            right.reshape(n, 6 * 7),
+            np.broadcast_to(_EAN_EDGE, (n, _EAN_EDGE.size)),
+        )
+    )
+
+
+def _bars_to_png(bars: np.ndarray) -> bytes:
+    """
+    Zeichnet ein Balkenmuster (True = Balken) als 1-Bit-PNG – ohne Text,
+    ohne Antialiasing.
+    """
+    # Eine Pixelzeile bauen und für die Balkenhöhe wiederholen
+    line = np.pad(np.repeat(bars, _MODULE_PX), _QUIET_PX)
+    line = np.where(line, 0, 255).astype(np.uint8)
+    pixels = np.broadcast_to(line, (_BAR_HEIGHT_PX, line.size))
+    img = Image.fromarray(np.ascontiguousarray(pixels), "L")
+
+    buf = io.BytesIO()
+    # Niedrige Kompressionsstufe: deutlich schneller, die Bilder sind
+    # ohnehin klein
+    img.convert("1").save(buf, format="PNG", optimize=False, compress_level=1)
+    return buf.getvalue()
+
+
+def _render_barcode(task):
+    """
+    Rendert einen Barcode als PNG im Speicher. Läuft in einem
+    Worker-Prozess, daher auf Modulebene und ohne Zugriff auf das Workbook.
+
+    Gibt (Cache-Schlüssel, PNG-Bytes, Fehler) zurück.
+    """
+    key, ean_str, bc_class, bars = task
+    try:
+        # EAN-13 kommen bereits fertig kodiert an (siehe
+        # _encode_ean13_batch), alles andere kodiert python-barcode
+        if bars is None:
+            # Nur das Balkenmuster von python-barcode verwenden und selbst
+            # rastern – die Schrift-/Antialiasing-Arbeit entfällt
+            modules = bc_class(ean_str, writer=_WRITER).build()[0]
+            bars = np.frombuffer(modules.encode("ascii"), dtype=np.uint8)
+            bars = bars != ord("0")
+        png = _bars_to_png(bars)
+    except Exception as err:
+        return key, None, str(err)
+    return key, png, None
 
 
 def generate_excel_with_barcodes(
@@ -32,12 +204,7 @@ def generate_excel_with_barcodes(
     row_height: float,
     col_width: float,
 ) -> io.BytesIO:
-    # Excel einlesen (erste Tabelle, ohne Header-Interpretation)
-    xls = pd.ExcelFile(uploaded_file)
-    sheet_name = xls.sheet_names[0]
-    df = xls.parse(sheet_name, header=None)
-
-    # Excel-Zeilen (1-basiert) → 0-basiert für pandas/xlsxwriter
+    # Excel-Zeilen (1-basiert) → 0-basiert für xlsxwriter
     header_row_idx = header_row_excel - 1
     data_start_idx = data_start_row_excel - 1
 
@@ -45,85 +212,173 @@ def generate_excel_with_barcodes(
     ean_col_idx = excel_col_to_index(ean_col_letter)
     barcode_col_idx = excel_col_to_index(barcode_col_letter)
 
-    # Sicherstellen, dass es mindestens bis zur Barcode-Spalte Spalten gibt
-    while df.shape[1] <= barcode_col_idx:
-        df[df.shape[1]] = None
-
-    # Temporäres Verzeichnis für Barcode-Bilder
-    tmpdir = tempfile.mkdtemp()
-
-    # Output im Speicher (BytesIO), damit wir einen Download anbieten können
+    # Excel einlesen (erste Tabelle). read_only liefert die Zeilen als
+    # Stream, ohne das ganze Blatt erst als DataFrame aufzubauen.
+    wb = openpyxl.load_workbook(uploaded_file, read_only=True, data_only=True)
+    ws = wb.worksheets[0]
+    # Die <dimension>-Angabe der Datei ist nicht immer korrekt – im
+    # read_only-Modus würden sonst Zeilen/Spalten abgeschnitten
+    ws.reset_dimensions()
+    sheet_name = ws.title
+
+    # Output im Speicher (BytesIO), damit wir einen Download anbieten können.
+    # constant_memory schreibt jede fertige Zeile sofort weg, statt das
+    # ganze Blatt im RAM zu halten (in_memory würde das wieder abschalten).
+    # Dafür muss das Blatt strikt Zeile für Zeile von oben befüllt werden.
+    # Die Zwischendateien von constant_memory landen in einem eigenen
+    # temporären Verzeichnis, das auch bei einem Fehler wieder entfernt
+    # wird. Bewusst nicht /dev/shm: das ist in Containern oft nur 64 MB
+    # groß und reicht für große Listen nicht.
     output = io.BytesIO()
-    workbook = xlsxwriter.Workbook(output, {"in_memory": True})
-    worksheet = workbook.add_worksheet(sheet_name)
-
-    rows, cols = df.shape
-
-    # Alle vorhandenen Werte aus df in das neue Sheet schreiben
-    for r in range(rows):
-        for c in range(cols):
-            val = df.iat[r, c]
-            if pd.isna(val):
-                continue
-            worksheet.write(r, c, val)
-
-    # Überschrift für Barcode-Spalte (z.B. Zeile 13)
-    worksheet.write(header_row_idx, barcode_col_idx, "Barcode")
-
-    # Spalte für Barcodes etwas breiter machen
-    worksheet.set_column(barcode_col_idx, barcode_col_idx, col_width)
-
-    # Zeilenhöhe ab Datenbeginn erhöhen (für bessere Scanbarkeit)
-    for r in range(data_start_idx, rows):
-        worksheet.set_row(r, row_height)
-
-    # Zeilenweise Barcodes generieren und in Barcode-Spalte einfügen
-    for r in range(data_start_idx, rows):
-        ean_val = df.iat[r, ean_col_idx]
-
-        if pd.isna(ean_val):
-            continue
-
-        ean_str = str(ean_val).strip()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workbook = xlsxwriter.Workbook(
+            output, {"constant_memory": True, "tmpdir": tmpdir}
+        )
+        worksheet = workbook.add_worksheet(sheet_name)
 
-        # Typischer Fall: Excel hat aus EAN eine Zahl mit .0 gemacht
-        if ean_str.endswith(".0"):
-            ean_str = ean_str[:-2]
+        # Spalte für Barcodes etwas breiter machen
+        worksheet.set_column(barcode_col_idx, barcode_col_idx, col_width)
 
-        # Nur Ziffern behalten
-        ean_str = "".join(ch for ch in ean_str if ch.isdigit())
+        # Zeilenhöhe ab Datenbeginn erhöhen (für bessere Scanbarkeit):
+        # einmal als Standardhöhe statt für jede Zeile einzeln. Nur die
+        # wenigen Zeilen davor bekommen unten wieder Excels normale Höhe.
+        worksheet.set_default_row(row_height)
+        blank_fmt = workbook.add_format()
 
-        if not ean_str:
-            continue
+        # Ein Durchlauf: jede gelesene Zeile sofort ins neue Sheet schreiben
+        # und nebenbei die EAN-Spalte ab Datenbeginn einsammeln
+        ean_values = []
+        rows = 0
+        try:
+            for r, row in enumerate(ws.iter_rows(values_only=True)):
+                rows = r + 1
+
+                if r < data_start_idx:
+                    worksheet.set_row(r, _EXCEL_ROW_HEIGHT)
+                    # constant_memory schreibt Zeilenhöhen nur für Zeilen mit
+                    # mindestens einer Zelle – leere Zeilen brauchen daher eine
+                    # leere Zelle, sonst bekämen sie die neue Standardhöhe
+                    if all(v is None for v in row):
+                        worksheet.write_blank(r, 0, None, blank_fmt)
+                else:
+                    ean_values.append(
+                        row[ean_col_idx] if ean_col_idx < len(row) else None
+                    )
+
+                # Leere Zellen (None) überspringt xlsxwriter ohne Format
+                worksheet.write_row(r, 0, row)
+
+                # Überschrift für Barcode-Spalte (z.B. Zeile 13)
+                if r == header_row_idx:
+                    worksheet.write(header_row_idx, barcode_col_idx, "Barcode")
+        finally:
+            wb.close()
+
+        # Überschriftzeile liegt hinter der letzten Zeile der Datei
+        if header_row_idx >= rows:
+            worksheet.write(header_row_idx, barcode_col_idx, "Barcode")
+
+        # EAN-Spalte einmal komplett bereinigen statt Zeile für Zeile:
+        # Leerzeichen weg, ".0" entfernen (Excel hat aus der EAN eine Zahl
+        # gemacht) und nur Ziffern behalten. Leere Zellen werden zu "".
+        eans = pd.Series(ean_values, dtype="string")
+        eans = (
+            eans.str.strip()
+            .str.removesuffix(".0")
+            .str.replace(_NONDIGIT, "", regex=True)
+        )
+        cleaned = eans.to_numpy(dtype=object, na_value="")
+
+        # Rohwerte und Series werden ab hier nicht mehr gebraucht – nicht
+        # während des gesamten Renderns im Speicher halten
+        del ean_values, eans
+
+        # Aufgaben sammeln – doppelte EANs (Varianten, Gebinde) nur einmal
+        # rendern und das Bild für alle Zeilen wiederverwenden
+        row_keys = []
+        tasks = {}
+        for r, ean_str in enumerate(cleaned, start=data_start_idx):
+            if not ean_str:
+                continue
 
-        # Barcode-Typ wählen
-        if len(ean_str) == 13:
-            bc_class = EAN13
-        elif len(ean_str) == 8:
-            bc_class = EAN8
+            # Barcode-Typ wählen
+            bc_class = _BC_BY_LEN.get(len(ean_str), Code128)
+            key = (bc_class.__name__, ean_str)
+            row_keys.append((r, key))
+            if key not in tasks:
+                tasks[key] = (key, ean_str, bc_class, None)
+
+        # Alle EAN-13 (der Normalfall) in einem Rutsch kodieren statt einzeln.
+        # Verschiedene EANs können dasselbe Balkenmuster ergeben (z.B. bei
+        # falscher Prüfziffer, die neu berechnet wird) – solche Muster nur
+        # einmal rendern.
+        same_bars = {}
+        # Nur ASCII-Ziffern: andere Unicode-Ziffern (z.B. vollbreite) gehen
+        # einzeln über python-barcode, damit ein solcher Code nicht den
+        # ganzen Stapel und damit die ganze Datei scheitern lässt
+        ean13_keys = [
+            key
+            for key, task in tasks.items()
+            if task[2] is EAN13 and key[1].isascii()
+        ]
+        if ean13_keys:
+            ean13_bars = _encode_ean13_batch([key[1] for key in ean13_keys])
+            first_by_bars = {}
+            for key, bars in zip(ean13_keys, ean13_bars):
+                # Das Muster selbst (95 Bytes) als exakter Schlüssel
+                first = first_by_bars.setdefault(bars.tobytes(), key)
+                if first == key:
+                    tasks[key] = (key, key[1], EAN13, bars)
+                else:
+                    same_bars[key] = first
+                    del tasks[key]
+            del ean13_bars, first_by_bars
+
+        # Barcode-Bilder rendern (reine CPU-Arbeit, EANs sind unabhängig
+        # voneinander). Ein Prozess-Pool lohnt sich erst bei vielen
+        # verschiedenen Codes, darunter kostet das Starten der Worker mehr
+        # als das Rendern selbst.
+        workers = _worker_count()
+        if workers > 1 and len(tasks) >= _POOL_MIN_TASKS:
+            with ProcessPoolExecutor(max_workers=workers) as ex:
+                results = list(
+                    ex.map(_render_barcode, tasks.values(), chunksize=64)
+                )
         else:
-            # Fallback: Code128 für „ungewöhnliche“ Längen
-            bc_class = Code128
-
-        try:
-            # Dateiname für dieses Bild
-            base_path = os.path.join(tmpdir, f"barcode_row_{r}")
-            bc_obj = bc_class(ean_str, writer=ImageWriter())
-            img_file = bc_obj.save(base_path)  # gibt Pfad inkl. Endung zurück
+            results = map(_render_barcode, tasks.values())
+
+        cache: dict[tuple[str, str], tuple[bytes | None, str | None]] = {}
+        for key, png, err in results:
+            cache[key] = (png, err)
+        del tasks, results
+
+        for key, first in same_bars.items():
+            cache[key] = cache[first]
+
+        # Bilder in Zelle (r, Barcode-Spalte) einfügen – xlsxwriter ist nicht
+        # thread-sicher, daher im Hauptprozess. Bilder hängen nicht an den
+        # bereits geschriebenen Zeilen und dürfen daher auch im
+        # constant_memory-Modus nachträglich eingefügt werden.
+        for r, key in row_keys:
+            png, err = cache[key]
+            if err is not None:
+                # Wenn eine Zeile Probleme macht, überspringen
+                print(f"Fehler in Zeile {r+1} für EAN {key[1]}: {err}")
+                continue
 
-            # Bild in Zelle (r, Barcode-Spalte) einfügen
+            # Eigener BytesIO pro Aufruf, da xlsxwriter die Daten erst beim
+            # Schließen des Workbooks liest. xlsxwriter erkennt doppelte
+            # Bilder am SHA-256 der Bilddaten (nicht am Namen) – da gleiche
+            # EANs dieselben PNG-Bytes aus dem Cache bekommen, landet jedes
+            # Bild nur einmal in xl/media/.
             worksheet.insert_image(
                 r,
                 barcode_col_idx,
-                img_file,
-                {"x_scale": 0.7, "y_scale": 0.7},
+                f"bc_{key[1]}.png",
+                {"image_data": io.BytesIO(png), "x_scale": 0.7, "y_scale": 0.7},
             )
-        except Exception as err:
-            # Wenn eine Zeile Probleme macht, überspringen
-            print(f"Fehler in Zeile {r+1} für EAN {ean_str}: {err}")
-            continue
 
-    workbook.close()
+        workbook.close()
     output.seek(0)
     return output
 